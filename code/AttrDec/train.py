@@ -88,7 +88,7 @@ def evaluate(net, criterion, vocab, data_iter, train_next=True):
                               trg_lens, test=False)
             pre_output = net(src, trg, src_embed, trg_embed, src_user, src_product, vocab.word_num, src_mask, src_lens,
                              trg_lens, test=True)
-            output = torch.log(pre_output1.view(-1, pre_output1.size(-1)) + 1e-20)
+            output = pre_output1.view(-1, pre_output1.size(-1))
             trg_output = trg.view(-1)
             loss += criterion(output, trg_output).data.item() / len(src_lens)
             reviews.extend(src_text)
@@ -206,7 +206,7 @@ def train():
                 batch)
             pre_output = net(src, trg, src_embed, trg_embed, src_user, src_product, vocab.word_num, src_mask,
                              src_lens, trg_lens)
-            pre_output = torch.log(pre_output.view(-1, pre_output.size(-1)) + 1e-20)
+            pre_output = pre_output.view(-1, pre_output.size(-1))
             trg_output = trg.view(-1)
             loss = criterion(pre_output, trg_output) / len(src_lens)
             loss.backward()
@@ -80,7 +80,7 @@ def evaluate(net, criterion, vocab, data_iter, train_next=True):
         src, trg, src_embed, trg_embed, src_mask, src_lens, trg_lens, src_text, trg_text = vocab.read_batch(
             batch)
         pre_output = net(src, trg, src_embed, trg_embed, vocab.word_num, src_mask, src_lens, trg_lens, test=True)
-        output = torch.log(pre_output.view(-1, pre_output.size(-1)) + 1e-20)
+        output = pre_output.view(-1, pre_output.size(-1))
         trg_output = trg.view(-1)
         loss += criterion(output, trg_output).data.item() / len(src_lens)
         reviews.extend(src_text)
@@ -188,7 +188,7 @@ def train():
         for i, batch in enumerate(train_iter):
             src, trg, src_embed, trg_embed, src_mask, src_lens, trg_lens, _1, _2 = vocab.read_batch(batch)
             output = net(src, trg, src_embed, trg_embed, vocab.word_num, src_mask, src_lens, trg_lens)
-            output = torch.log(output.view(-1, output.size(-1)) + 1e-20)
+            output = output.view(-1, output.size(-1))
             trg_output = trg.view(-1)
             loss = criterion(output, trg_output) / len(src_lens)
             loss.backward()
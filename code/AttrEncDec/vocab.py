@@ -10,7 +10,6 @@ import torch.utils.data as data
 class Vocab:
     def __init__(self, args, embed=None):
         self.args = args
-        self.embed = []
         self.PAD_IDX = 0
         self.SOS_IDX = 1
         self.EOS_IDX = 2
@@ -34,16 +33,20 @@ class Vocab:
         self.product2id = {'<UNK-PRODUCT>': 0}
         self.id2product = {0: '<UNK-PRODUCT>'}
         self.product2cnt = {'<UNK-PRODUCT>': 10000}
-        for i in range(4):
-            self.embed.append(np.random.normal(size=args.embed_dim))
+        # embed: [pretrained_num, embed_dim] float32 array, row i is the vector of word i
+        # special tokens get random rows here, words added later get random rows in trim()
+        pretrained = []
         if embed is not None:
             for w in sorted(embed.keys()):
                 if w not in self.word2id:
                     self.word2id[w] = self.word_num
                     self.id2word[self.word_num] = w
                     self.word2cnt[w] = 0
-                    self.embed.append(embed[w])
+                    pretrained.append(embed[w])
                     self.word_num += 1
+        self.embed = np.concatenate([np.random.normal(size=(4, args.embed_dim)).astype(np.float32),
+                                     np.asarray(pretrained, dtype=np.float32).reshape(-1, args.embed_dim)])
+        self.pretrained_num = self.word_num
         self.fixed_num = self.word_num
 
     def add_sentence(self, sent):
@@ -52,7 +55,6 @@ class Vocab:
                 self.word2id[w] = self.word_num
                 self.id2word[self.word_num] = w
                 self.word2cnt[w] = 1
-                self.embed.append(np.random.normal(size=self.args.embed_dim))
                 self.word_num += 1
             else:
                 self.word2cnt[w] += 1
@@ -86,18 +88,23 @@ class Vocab:
                 reserved_idx.append(i)
         cnt = 0
         word2id, id2word, word2cnt = {}, {}, {}
-        embed = []
         for w in reserved_words:
             word2id[w] = cnt
             id2word[cnt] = w
             word2cnt[w] = self.word2cnt[w]
             cnt += 1
-        for i in reserved_idx:
-            embed.append(self.embed[i])
+        # reserved ids are sorted, those below pretrained_num take their rows from self.embed,
+        # the rest get random vectors drawn in one call
+        reserved_idx = np.asarray(reserved_idx, dtype=np.int64)
+        kept_num = np.searchsorted(reserved_idx, self.pretrained_num)
+        embed = np.empty((cnt, self.args.embed_dim), dtype=np.float32)
+        embed[:kept_num] = self.embed[reserved_idx[:kept_num]]
+        embed[kept_num:] = np.random.normal(size=(cnt - kept_num, self.args.embed_dim))
         self.word_num = cnt
         self.fixed_num = cnt
         assert len(word2id) == len(id2word) and len(id2word) == len(word2cnt) and len(word2cnt) == len(embed)
         self.word2id, self.id2word, self.word2cnt, self.embed = word2id, id2word, word2cnt, embed
+        self.pretrained_num = cnt
         print('Vocab size: %d' % len(self.word2id))
 
         print('original user num = %d, product num = %d' % (self.user_num, self.product_num))
@@ -136,17 +143,18 @@ class Vocab:
             self.word2id[user] = self.fixed_num
             self.id2word[self.fixed_num] = user
             self.word2cnt[user] = 10000
-            self.embed.append(np.random.normal(size=self.args.embed_dim))
             self.fixed_num += 1
         for i in range(self.product_num):
             pro = self.id2product[i]
             self.word2id[pro] = self.fixed_num
             self.id2word[self.fixed_num] = pro
             self.word2cnt[pro] = 10000
-            self.embed.append(np.random.normal(size=self.args.embed_dim))
             self.fixed_num += 1
+        # user and product rows, drawn in one call
+        attr_embed = np.random.normal(size=(self.user_num + self.product_num, self.args.embed_dim))
+        self.embed = np.concatenate([self.embed, attr_embed.astype(np.float32)])
         self.word_num = self.fixed_num
-        self.embed = torch.FloatTensor(self.embed)
+        self.embed = torch.from_numpy(self.embed)
         if self.args.use_cuda:
             self.embed = self.embed.cuda()
         return self.embed
@@ -173,40 +181,43 @@ class Vocab:
         for review, summary in zip(batch['reviewText'], batch['summary']):
             src_text.append(review)
             trg_text.append(summary)
-        idx = list(range(len(batch['summary'])))
-        idx.sort(key=lambda k: len(src_text[k].split()), reverse=True)
+        # split every text once, the token lists are reused below
+        src_tokens = [review.split() for review in src_text]
+        trg_tokens = [summary.split() for summary in trg_text]
+        lens = np.fromiter((len(review) for review in src_tokens), dtype=np.int64, count=len(src_tokens))
+        idx = np.argsort(-lens, kind='stable')  # longest first, ties keep batch order
         src_text = [src_text[i] for i in idx]
         trg_text = [trg_text[i] for i in idx]
+        src_tokens = [src_tokens[i] for i in idx]
+        trg_tokens = [trg_tokens[i] for i in idx]
 
         # generate changeable part for current batch
-        for review in src_text:
-            review = review.split()
+        for review in src_tokens:
             for w in review:
                 if w not in self.word2id:
                     self.word2id[w] = self.word_num
                     self.id2word[self.word_num] = w
                     self.word_num += 1
 
-        src_max_len = len(src_text[0].split()) + 2
+        src_max_len = len(src_tokens[0]) + 2
         trg_max_len = self.args.sum_max_len
-        src, trg, src_mask, src_lens, trg_lens = [], [], [], [], []
+        src, trg, src_lens, trg_lens = [], [], [], []
         src_embed, trg_embed = [], []
-        for i, review in zip(idx, src_text):
+        for i, review in zip(idx, src_tokens):
             user, product = batch['userID'][i], batch['productID'][i]
             assert user in self.user2id and product in self.product2id
             user = user if user in self.user2id else '<UNK-USER>'
             product = product if product in self.product2id else '<UNK-PRODUCT>'
-            review = [user, product] + review.split()[:src_max_len - 2]
+            review = [user, product] + review[:src_max_len - 2]
             cur_idx = []
             for w in review:
                 cur_idx.append(self.word_id(w))
             cur_idx.extend([self.PAD_IDX] * (src_max_len - len(review)))
             src.append(cur_idx)
             src_embed.append([i if i < self.fixed_num else self.UNK_IDX for i in cur_idx])
-            src_mask.append([1] * len(review) + [0] * (src_max_len - len(review)))
             src_lens.append(len(review))
-        for i, summary in enumerate(trg_text):
-            summary = summary.split() + [self.EOS_TOKEN]
+        for i, summary in enumerate(trg_tokens):
+            summary = summary + [self.EOS_TOKEN]
             summary = summary[:trg_max_len]
             cur_idx = []
             for w in summary:
@@ -219,7 +230,8 @@ class Vocab:
             trg_embed.append([i if i < self.fixed_num else self.UNK_IDX for i in cur_idx])
             trg_lens.append(len(summary))
 
-        src, trg, src_mask = torch.LongTensor(src), torch.LongTensor(trg), torch.LongTensor(src_mask)
+        src, trg = torch.LongTensor(src), torch.LongTensor(trg)
+        src_mask = (torch.arange(src_max_len).unsqueeze(0) < torch.LongTensor(src_lens).unsqueeze(1)).long()
         src_embed, trg_embed = torch.LongTensor(src_embed), torch.LongTensor(trg_embed)
         if self.args.use_cuda:
             src, trg, src_mask = src.cuda(), trg.cuda(), src_mask.cuda()
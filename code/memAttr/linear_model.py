@@ -1,4 +1,5 @@
 # coding: utf-8
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -17,6 +18,8 @@ class MemAttrLinear(nn.Module):
         self.embed = nn.Embedding(args.embed_num, args.embed_dim)
         if embed is not None:
             self.embed.weight.data.copy_(embed)
+        # <SOS> index, first decoder input
+        self.register_buffer('sos_idx', torch.LongTensor([1]), persistent=False)
 
         # Review Encoder
         self.review_encoder = nn.GRU(args.embed_dim, args.hidden_size, args.rnn_layers, batch_first=True,
@@ -32,10 +35,8 @@ class MemAttrLinear(nn.Module):
         # Memory fusion layer
         self.mem_fusion = nn.Linear(4 * args.hidden_size, 2 * args.hidden_size)  # [u_mem_out:p_mem_out] => mem_out
 
-        # User embedding layer
-        self.user_embed = nn.Embedding(args.user_num, args.attr_dim)
-        # Product embedding layer
-        self.product_embed = nn.Embedding(args.product_num, args.attr_dim)
+        # User and product embedding layer, one table: users first, product ids are offset by user_num
+        self.attr_embed = nn.Embedding(args.user_num + args.product_num, args.attr_dim)
         # Encoder final layer
         self.encoder_final = nn.Linear(4 * args.hidden_size + 2 * args.attr_dim, args.hidden_size)
 
@@ -45,8 +46,8 @@ class MemAttrLinear(nn.Module):
         if self.highway:
             decode_size += args.hidden_size
         # Decoder
-        self.decoder_rnn = nn.GRU(decode_size, args.hidden_size, args.rnn_layers, batch_first=True,
-                                  dropout=args.decoder_dropout)
+        self.decoder_rnn = StepGRU(decode_size, args.hidden_size, args.rnn_layers, batch_first=True,
+                                   dropout=args.decoder_dropout)
         # Text Attention
         self.attention = Attention(args.hidden_size)
         # Attributes Attention
@@ -65,7 +66,7 @@ class MemAttrLinear(nn.Module):
         # copy mode layer, no learnable paras, attn_scores => word distribution over src vocab, P(other vocab) = 0
 
     def decode_step(self, src, prev_embed, encoder_hidden, src_mask, proj_key, encoder_attr,
-                    proj_key_attr, hidden, context_hidden, vocab_size, mem_out, highway):
+                    proj_key_attr, hidden, context_hidden, gen_pad, copy_zeros, mem_out, highway):
         """Perform a single decoder step (1 word)"""
 
         # update rnn hidden state
@@ -86,20 +87,20 @@ class MemAttrLinear(nn.Module):
         # generate mode word distribution
         context_hidden = torch.tanh(self.context_hidden(torch.cat([query, context], dim=2)))
         context_hidden = self.dropout_layer(context_hidden)
-        gen_prob = F.softmax(self.generator(context_hidden), dim=-1)
-        if vocab_size > gen_prob.size(2):
-            gen_prob = torch.cat(
-                [gen_prob, torch.zeros(gen_prob.size(0), gen_prob.size(1), vocab_size - gen_prob.size(2)).cuda()],
-                dim=-1)
+        gen_log_prob = F.log_softmax(self.generator(context_hidden), dim=-1)
+        if gen_pad is not None:
+            gen_log_prob = torch.cat([gen_log_prob, gen_pad], dim=-1)
 
         # copy mode word distribution
         src = src.unsqueeze(1)
-        copy_prob = torch.zeros(src.size(0), src.size(1), vocab_size).cuda().scatter_add(2, src, attn_probs)
+        copy_prob = copy_zeros.scatter_add(2, src, attn_probs.float())
 
-        # generate probability p
-        gen_p = torch.sigmoid(self.gen_p(torch.cat([context, query, prev_embed], -1)))
-        mix_prob = gen_p * gen_prob + (1 - gen_p) * copy_prob
-        return hidden, context_hidden, mix_prob
+        # generate probability p, words are mixed in log space: log(p * gen_prob + (1 - p) * copy_prob)
+        # copy_prob is clamped so that words absent from src get a finite log and no nan gradient
+        gen_logit = self.gen_p(torch.cat([context, query, prev_embed], -1))
+        mix_log_prob = torch.logaddexp(F.logsigmoid(gen_logit) + gen_log_prob,
+                                       F.logsigmoid(-gen_logit) + torch.log(copy_prob.clamp(min=1e-20)))
+        return hidden, context_hidden, mix_log_prob
 
     def forward(self, src, trg, src_, trg_, user, product, vocab_size, u_review, u_sum, p_review, p_sum, test=False):
         # useful variables
@@ -133,6 +134,8 @@ class MemAttrLinear(nn.Module):
         packed = pack_padded_sequence(src_, src_lens, batch_first=True)
         encoder_hidden, encoder_final = self.review_encoder(packed)
         encoder_hidden, _ = pad_packed_sequence(encoder_hidden, batch_first=True)  # encoder_hidden: [B, S, 2H]
+        # contiguous once for all decoder steps
+        encoder_hidden = encoder_hidden.contiguous()
         fwd_final = encoder_final[0:encoder_final.size(0):2]
         bwd_final = encoder_final[1:encoder_final.size(0):2]
         text_final = torch.cat([fwd_final, bwd_final], dim=2).transpose(0, 1)  # text_final: [B, num_layers, 2H]
@@ -180,10 +183,9 @@ class MemAttrLinear(nn.Module):
             p_query = self.new_query(torch.cat([p_query, p_mem_out], dim=-1))
         mem_out = self.mem_fusion(torch.cat([u_mem_out, p_mem_out], dim=-1)).unsqueeze(1)
 
-        user_embed = self.user_embed(user)  # user_embed: [B, A]
-        product_embed = self.product_embed(product)  # product_embed: [B, A]
-        attr_final = torch.cat([user_embed, product_embed], dim=-1).unsqueeze(1)
-        encoder_attr = torch.cat([user_embed, product_embed], dim=-1).view(user_embed.size(0), 2, -1)
+        attr_idx = torch.stack([user, product + self.args.user_num], dim=1)  # attr_idx: [B, 2]
+        encoder_attr = self.attr_embed(attr_idx)  # encoder_attr: [B, 2, A], user then product
+        attr_final = encoder_attr.view(batch_size, 1, -1)
 
         encoder_final = self.encoder_final(torch.cat(
             [text_final, attr_final.repeat(1, text_final.size(1), 1), mem_out.repeat(1, text_final.size(1), 1)],
@@ -204,22 +206,27 @@ class MemAttrLinear(nn.Module):
         proj_key_attr = self.attention_attr.key_layer(encoder_attr)
         pre_output_vectors = []
 
+        # constant tensors shared by all decoder steps, allocated on device once per batch
+        # gen_pad: log prob of the changeable vocab part in generate mode, copy_zeros: base of copy mode distribution
+        gen_pad = None
+        if vocab_size > self.args.embed_num:
+            gen_pad = encoder_hidden.new_full((batch_size, 1, vocab_size - self.args.embed_num), -float('inf'))
+        copy_zeros = encoder_hidden.new_zeros(batch_size, 1, vocab_size, dtype=torch.float)
+
         # unroll the decoder RNN for max_len steps
         for i in range(max_len):
             if i == 0:  # <SOS> embedding
-                prev_embed = self.embed(torch.LongTensor([1]).cuda()).repeat(len(src), 1).unsqueeze(1)
+                prev_embed = self.embed(self.sos_idx).expand(len(src), 1, -1)
             else:
                 if not test:  # last trg word embedding
                     prev_embed = trg_embed[:, i - 1].unsqueeze(1)
                 else:  # last predicted word embedding
                     prev_idx = torch.argmax(pre_output_vectors[-1], dim=-1)
-                    for j in range(0, prev_idx.size(0)):
-                        if prev_idx[j][0] >= self.args.embed_num:
-                            prev_idx[j][0] = 3  # UNK_IDX
+                    prev_idx = prev_idx.masked_fill(prev_idx >= self.args.embed_num, 3)  # UNK_IDX
                     prev_embed = self.embed(prev_idx)
             hidden, context_hidden, word_prob = self.decode_step(src, prev_embed, encoder_hidden, src_mask,
                                                                  proj_key, encoder_attr, proj_key_attr, hidden,
-                                                                 context_hidden, vocab_size, mem_out, highway)
+                                                                 context_hidden, gen_pad, copy_zeros, mem_out, highway)
             pre_output_vectors.append(word_prob)
         pre_output_vectors = torch.cat(pre_output_vectors, dim=1)
         return pre_output_vectors
@@ -228,6 +235,44 @@ class MemAttrLinear(nn.Module):
         checkpoint = {'model': self.state_dict(), 'args': self.args}
         torch.save(checkpoint, dir)
 
+    # checkpoints saved before the user and product tables were merged into attr_embed
+    def load_state_dict(self, state_dict, strict=True):
+        if 'user_embed.weight' in state_dict:
+            # keep the per-module versions used by load_state_dict migrations, attr_embed takes user_embed's
+            metadata = getattr(state_dict, '_metadata', None)
+            state_dict = OrderedDict(state_dict)
+            if metadata is not None:
+                metadata = OrderedDict(metadata)
+                metadata['attr_embed'] = metadata.pop('user_embed', {})
+                metadata.pop('product_embed', None)
+                state_dict._metadata = metadata
+            state_dict['attr_embed.weight'] = torch.cat([state_dict.pop('user_embed.weight'),
+                                                         state_dict.pop('product_embed.weight')])
+        return super(MemAttrLinear, self).load_state_dict(state_dict, strict)
+
+
+# nn.GRU for a single decoder step: each layer runs as a GRU cell, skipping the cudnn sequence setup
+# parameters (and state_dict keys) are the same as nn.GRU, input: [B, 1, I], hx: [num_layers, B, H]
+class StepGRU(nn.GRU):
+
+    def forward(self, input, hx):
+        x, hidden = input.squeeze(1), []
+        for l in range(self.num_layers):
+            if l > 0:
+                x = F.dropout(x, p=self.dropout, training=self.training)
+            x = torch.gru_cell(x, hx[l], getattr(self, 'weight_ih_l%d' % l), getattr(self, 'weight_hh_l%d' % l),
+                               getattr(self, 'bias_ih_l%d' % l), getattr(self, 'bias_hh_l%d' % l))
+            hidden.append(x)
+        return x.unsqueeze(1), torch.stack(hidden)
+
+
+@torch.jit.script
+def additive_scores(query, proj_key, energy_weight):
+    # v * tanh(W1 * hi + W2 * hj) over all keys => [B, 1, max_len]
+    # scripted so that the broadcast add and tanh run as one fused kernel on gpu
+    # the weight is cast to the activations' dtype, autocast (-amp) is not guaranteed to reach scripted code
+    return torch.matmul(torch.tanh(query + proj_key), energy_weight.to(query.dtype).t()).transpose(1, 2)
+
 
 class Attention(nn.Module):
 
@@ -251,8 +296,7 @@ class Attention(nn.Module):
         query = self.query_layer(query)
 
         # Calculate scores.
-        scores = self.energy_layer(torch.tanh(query + proj_key))
-        scores = scores.squeeze(2).unsqueeze(1)
+        scores = additive_scores(query, proj_key, self.energy_layer.weight)
 
         # Mask out invalid positions.
         # The mask marks valid positions so we invert it using `mask & 0`.
@@ -6,6 +6,7 @@ import os
 import json
 import argparse
 import random
+from functools import partial
 import numpy as np
 from tqdm import tqdm
 import torch
@@ -49,6 +50,8 @@ parser.add_argument('-lr_decay_ratio', type=float, default=0.5)
 parser.add_argument('-lr_decay_start', type=int, default=6)
 parser.add_argument('-max_norm', type=float, default=5.0)
 parser.add_argument('-batch_size', type=int, default=16)
+parser.add_argument('-num_workers', type=int, default=4)
+parser.add_argument('-amp', action='store_true')
 parser.add_argument('-epochs', type=int, default=12)
 parser.add_argument('-seed', type=int, default=2333)
 parser.add_argument('-print_every', type=int, default=10)
@@ -71,8 +74,9 @@ if not os.path.exists(args.save_path):
 if not os.path.exists(args.output_dir):
     os.mkdir(args.output_dir)
 
-def my_collate(batch):
-    return {key: [d[key] for d in batch] for key in batch[0]}
+def my_collate(batch, vocab, train_data):
+    batch = {key: [d[key] for d in batch] for key in batch[0]}
+    return vocab.make_tensors(batch, train_data)
 
 
 def adjust_learning_rate(optimizer, times):
@@ -81,7 +85,7 @@ def adjust_learning_rate(optimizer, times):
         param_group['lr'] = lr
 
 
-def evaluate(net, criterion, vocab, data_iter, train_data, train_next=True):
+def evaluate(net, criterion, vocab, data_iter, train_next=True):
     net.eval()
     reviews = []
     refs = []
@@ -89,13 +93,16 @@ def evaluate(net, criterion, vocab, data_iter, train_data, train_next=True):
     loss, r1, r2, rl = .0, .0, .0, .0
     rouge = RougeCalculator(stopwords=False, lang="en")
     for batch in tqdm(data_iter):
-        src, trg, src_embed, trg_embed, src_user, src_product, u_review, u_sum, p_review, p_sum, src_text, trg_text \
-            = vocab.make_tensors(batch, train_data)
-        sum_out = net(src, trg, src_embed, trg_embed, src_user, src_product, vocab.word_num, u_review, u_sum, p_review,
-                      p_sum, test=True)
-        sum_out_1 = net(src, trg, src_embed, trg_embed, src_user, src_product, vocab.word_num, u_review, u_sum,
-                        p_review, p_sum, test=False)
-        sum_out_1 = torch.log(sum_out_1.view(-1, sum_out_1.size(-1)) + 1e-20)
+        if args.use_cuda:
+            batch = batch.cuda()
+        src, trg, src_text, trg_text = batch['src'], batch['trg'], batch['src_text'], batch['trg_text']
+        sum_out = net(src, trg, batch['src_embed'], batch['trg_embed'], batch['src_user'], batch['src_product'],
+                      batch['vocab_size'], batch['u_review'], batch['u_sum'], batch['p_review'], batch['p_sum'],
+                      test=True)
+        sum_out_1 = net(src, trg, batch['src_embed'], batch['trg_embed'], batch['src_user'], batch['src_product'],
+                        batch['vocab_size'], batch['u_review'], batch['u_sum'], batch['p_review'], batch['p_sum'],
+                        test=False)
+        sum_out_1 = sum_out_1.view(-1, sum_out_1.size(-1))
         sum_out_gold = trg.view(-1)
         loss += criterion(sum_out_1, sum_out_gold).data.item() / len(src)
         reviews.extend(src_text)
@@ -107,7 +114,7 @@ def evaluate(net, criterion, vocab, data_iter, train_data, train_next=True):
             for j, idx in enumerate(summary):
                 if idx == vocab.EOS_IDX:
                     break
-                w = vocab.id_word(idx)
+                w = vocab.id_word(idx, batch['oov_words'])
                 cur_sum.append(w)
             cur_sum = ' '.join(cur_sum).strip()
             if len(cur_sum) == 0:
@@ -183,6 +190,7 @@ def train():
 
     print('Deleting rare words...')
     embed = vocab.trim()
+    vocab.encode_examples(train_data + val_data)
     args.embed_num = len(embed)
     args.embed_dim = len(embed[0])
     args.user_num = vocab.user_num
@@ -190,8 +198,13 @@ def train():
 
     train_dataset = Dataset(train_data)
     val_dataset = Dataset(val_data)
-    train_iter = DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=my_collate)
-    val_iter = DataLoader(dataset=val_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=my_collate)
+    collate = partial(my_collate, vocab=vocab, train_data=train_data)
+    train_iter = DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=collate,
+                            num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                            pin_memory=args.use_cuda)
+    val_iter = DataLoader(dataset=val_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=collate,
+                          num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                          pin_memory=args.use_cuda)
 
     assert args.model == 'linear' or args.model == 'gate'
     if args.load_model is not None:
@@ -212,22 +225,30 @@ def train():
     net.train()
     criterion = nn.NLLLoss(ignore_index=vocab.PAD_IDX, reduction='sum')
     optim = torch.optim.Adam(net.parameters(), lr=args.lr)
+    # -amp: forward in mixed precision (fp16 matmuls and rnns, fp32 weights), loss scaled against fp16 underflow
+    use_amp = args.use_cuda and args.amp
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
 
     print('Begin training...')
     for epoch in range(args.begin_epoch, args.epochs + 1):
         if epoch >= args.lr_decay_start:
             adjust_learning_rate(optim, epoch - args.lr_decay_start + 1)
         for i, batch in enumerate(train_iter):
-            src, trg, src_, trg_, src_user, src_product, u_review, u_sum, p_review, p_sum, _1, _2 = vocab.make_tensors(
-                batch, train_data)
-            sum_output = net(src, trg, src_, trg_, src_user, src_product, vocab.word_num, u_review, u_sum, p_review,
-                             p_sum)
-            sum_output = torch.log(sum_output.view(-1, sum_output.size(-1)) + 1e-20)
+            if args.use_cuda:
+                batch = batch.cuda()
+            src, trg = batch['src'], batch['trg']
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                sum_output = net(src, trg, batch['src_embed'], batch['trg_embed'], batch['src_user'],
+                                 batch['src_product'], batch['vocab_size'], batch['u_review'], batch['u_sum'],
+                                 batch['p_review'], batch['p_sum'])
+            sum_output = sum_output.view(-1, sum_output.size(-1))
             sum_output_gold = trg.view(-1)
             loss = criterion(sum_output, sum_output_gold) / len(src)
-            loss.backward()
+            scaler.scale(loss).backward()
+            scaler.unscale_(optim)
             clip_grad_norm_(net.parameters(), args.max_norm)
-            optim.step()
+            scaler.step(optim)
+            scaler.update()
             optim.zero_grad()
 
             cnt = (epoch - 1) * len(train_iter) + i
@@ -235,7 +256,7 @@ def train():
                 print('EPOCH [%d/%d]: BATCH_ID=[%d/%d] loss=%f' % (epoch, args.epochs, i, len(train_iter), loss.data))
             if cnt % args.valid_every == 0:
                 print('Begin valid... Epoch %d, Batch %d' % (epoch, i))
-                cur_loss, r1, r2, rl = evaluate(net, criterion, vocab, val_iter, train_data, True)
+                cur_loss, r1, r2, rl = evaluate(net, criterion, vocab, val_iter, True)
                 save_path = args.save_path + 'valid_%d_%.4f_%.4f_%.4f_%.4f' % (
                     cnt / args.valid_every, cur_loss, r1, r2, rl)
                 net.save(save_path)
@@ -293,12 +314,16 @@ def test():
 
     print('Deleting rare words...')
     embed = vocab.trim()
+    vocab.encode_examples(train_data + test_data)
     args.embed_num = len(embed)
     args.embed_dim = len(embed[0])
     args.user_num = vocab.user_num
     args.product_num = vocab.product_num
     test_dataset = Dataset(test_data)
-    test_iter = DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=my_collate)
+    collate = partial(my_collate, vocab=vocab, train_data=train_data)
+    test_iter = DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=collate,
+                           num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                           pin_memory=args.use_cuda)
 
     print('Loading model...')
     assert args.model == 'linear' or args.model == 'gate'
@@ -313,7 +338,7 @@ def test():
     criterion = nn.NLLLoss(ignore_index=vocab.PAD_IDX, reduction='sum')
 
     print('Begin testing...')
-    loss, r1, r2, rl = evaluate(net, criterion, vocab, test_iter, train_data, False)
+    loss, r1, r2, rl = evaluate(net, criterion, vocab, test_iter, False)
     print('Loss: %f Rouge-1: %f Rouge-2: %f Rouge-l: %f' % (loss, r1, r2, rl))
 
 
@@ -365,12 +390,16 @@ def test_all():
 
     print('Deleting rare words...')
     embed = vocab.trim()
+    vocab.encode_examples(train_data + test_data)
     args.embed_num = len(embed)
     args.embed_dim = len(embed[0])
     args.user_num = vocab.user_num
     args.product_num = vocab.product_num
     test_dataset = Dataset(test_data)
-    test_iter = DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=my_collate)
+    collate = partial(my_collate, vocab=vocab, train_data=train_data)
+    test_iter = DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=collate,
+                           num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                           pin_memory=args.use_cuda)
 
     start, end = 10, 33
     fns = os.listdir(args.save_path)
@@ -392,7 +421,7 @@ def test_all():
         if args.use_cuda:
             net.cuda()
         criterion = nn.NLLLoss(ignore_index=vocab.PAD_IDX, reduction='sum')
-        loss, r1, r2, rl = evaluate(net, criterion, vocab, test_iter, train_data, True)
+        loss, r1, r2, rl = evaluate(net, criterion, vocab, test_iter, True)
         f.write('Idx: %d Loss: %f Rouge-1: %f Rouge-2: %f Rouge-l: %f\n' % (idx, loss, r1, r2, rl))
 
 
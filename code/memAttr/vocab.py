@@ -1,4 +1,5 @@
 # coding=utf-8
+import heapq
 import torch
 import numpy as np
 import torch.utils.data as data
@@ -10,7 +11,6 @@ import torch.utils.data as data
 class Vocab:
     def __init__(self, args, embed=None):
         self.args = args
-        self.embed = []
         self.PAD_IDX = 0
         self.SOS_IDX = 1
         self.EOS_IDX = 2
@@ -24,6 +24,7 @@ class Vocab:
         self.word2id = {self.PAD_TOKEN: self.PAD_IDX, self.SOS_TOKEN: self.SOS_IDX, self.EOS_TOKEN: self.EOS_IDX,
                         self.UNK_TOKEN: self.UNK_IDX}
         self.id2word = {v: k for k, v in self.word2id.items()}
+        self._w2i_get = self.word2id.get
         self.word2cnt = {self.PAD_TOKEN: 10000, self.SOS_TOKEN: 10000, self.EOS_TOKEN: 10000,
                          self.UNK_TOKEN: 10000}
         self.user_num = 1
@@ -34,16 +35,20 @@ class Vocab:
         self.product2id = {'<UNK-PRODUCT>': 0}
         self.id2product = {0: '<UNK-PRODUCT>'}
         self.product2cnt = {'<UNK-PRODUCT>': 10000}
-        for i in range(4):
-            self.embed.append(np.random.normal(size=args.embed_dim))
+        # embed: [pretrained_num, embed_dim] float32 array, row i is the vector of word i
+        # special tokens get random rows here, words added later get random rows in trim()
+        pretrained = []
         if embed is not None:
             for w in sorted(embed.keys()):
                 if w not in self.word2id:
                     self.word2id[w] = self.word_num
                     self.id2word[self.word_num] = w
                     self.word2cnt[w] = 0
-                    self.embed.append(embed[w])
+                    pretrained.append(embed[w])
                     self.word_num += 1
+        self.embed = np.concatenate([np.random.normal(size=(4, args.embed_dim)).astype(np.float32),
+                                     np.asarray(pretrained, dtype=np.float32).reshape(-1, args.embed_dim)])
+        self.pretrained_num = self.word_num
         self.fixed_num = self.word_num
 
     def add_sentence(self, sent):
@@ -52,7 +57,6 @@ class Vocab:
                 self.word2id[w] = self.word_num
                 self.id2word[self.word_num] = w
                 self.word2cnt[w] = 1
-                self.embed.append(np.random.normal(size=self.args.embed_dim))
                 self.word_num += 1
             else:
                 self.word2cnt[w] += 1
@@ -86,20 +90,26 @@ class Vocab:
                 reserved_idx.append(i)
         cnt = 0
         word2id, id2word, word2cnt = {}, {}, {}
-        embed = []
         for w in reserved_words:
             word2id[w] = cnt
             id2word[cnt] = w
             word2cnt[w] = self.word2cnt[w]
             cnt += 1
-        for i in reserved_idx:
-            embed.append(self.embed[i])
+        # reserved ids are sorted, those below pretrained_num take their rows from self.embed,
+        # the rest get random vectors drawn in one call
+        reserved_idx = np.asarray(reserved_idx, dtype=np.int64)
+        kept_num = np.searchsorted(reserved_idx, self.pretrained_num)
+        embed = np.empty((cnt, self.args.embed_dim), dtype=np.float32)
+        embed[:kept_num] = self.embed[reserved_idx[:kept_num]]
+        embed[kept_num:] = np.random.normal(size=(cnt - kept_num, self.args.embed_dim))
         self.word_num = cnt
         self.fixed_num = cnt
         assert len(word2id) == len(id2word) and len(id2word) == len(word2cnt) and len(word2cnt) == len(embed)
         self.word2id, self.id2word, self.word2cnt, self.embed = word2id, id2word, word2cnt, embed
+        self.pretrained_num = cnt
+        self._w2i_get = self.word2id.get
         print('Vocab size: %d' % len(self.word2id))
-        embed = torch.FloatTensor(embed)
+        embed = torch.from_numpy(embed)
         if self.args.use_cuda:
             embed = embed.cuda()
 
@@ -136,58 +146,85 @@ class Vocab:
         return embed
 
     def word_id(self, w):
-        if w in self.word2id:
-            return self.word2id[w]
-        return self.UNK_IDX
+        return self._w2i_get(w, self.UNK_IDX)
 
-    def id_word(self, idx):
+    # split a text into an int32 id array, done once per example after trim()
+    # words out of the fixed vocab get -(k + 1), k indexing the returned list of such words
+    def encode(self, text):
+        w2i_get, words, ids = self._w2i_get, {}, []
+        for w in text.split():
+            i = w2i_get(w)
+            if i is None:
+                i = -words.setdefault(w, len(words) + 1)
+            ids.append(i)
+        return np.asarray(ids, dtype=np.int32), list(words)
+
+    # store ids of review and summary in each example, make_tensors then only pads them
+    def encode_examples(self, examples):
+        for ex in examples:
+            ex['reviewText_ids'], ex['reviewText_oov'] = self.encode(ex['reviewText'])
+            ex['summary_ids'], ex['summary_oov'] = self.encode(ex['summary'])
+
+    # copy encoded texts into a [len(seqs), max_len] id matrix, truncated and padded with PAD_IDX
+    # eos: append EOS_IDX when there is room left
+    # words: per text out-of-vocab words from encode(), mapped through oov (changeable part of current batch,
+    # word => id >= fixed_num) or to UNK_IDX
+    def pad_ids(self, seqs, max_len, words=None, oov=None, eos=False):
+        seqs = [ids[:max_len] for ids in seqs]
+        lens = np.fromiter((len(ids) for ids in seqs), dtype=np.int64, count=len(seqs))
+        out = np.full((len(seqs), max_len), self.PAD_IDX, dtype=np.int64)
+        out[np.arange(max_len) < lens[:, None]] = np.concatenate(seqs)
+        if eos:
+            rows = np.nonzero(lens < max_len)[0]
+            out[rows, lens[rows]] = self.EOS_IDX
+        if words is None or oov is None:
+            out[out < 0] = self.UNK_IDX
+            return out
+        oov_get = oov.get
+        for row, ws in zip(out, words):
+            if ws:
+                local = np.array([oov_get(w, self.UNK_IDX) for w in ws], dtype=np.int64)
+                neg = row < 0
+                row[neg] = local[-row[neg] - 1]
+        return out
+
+    # replace ids in the changeable vocab part with UNK_IDX
+    def fixed_ids(self, ids):
+        return np.where(ids < self.fixed_num, ids, self.UNK_IDX)
+
+    def id_word(self, idx, oov_words=None):
+        if oov_words is not None and idx >= self.fixed_num:
+            return oov_words[idx - self.fixed_num]
         assert 0 <= idx < self.word_num
         return self.id2word[idx]
 
     # generate tensors for a batch
     def make_tensors(self, batch, train_data):
-        # delete the last changeable vocab part
-        for i in range(self.fixed_num, self.word_num):
-            w = self.id_word(i)
-            self.id2word.pop(i)
-            self.word2id.pop(w)
-        self.word_num = self.fixed_num
-
         src_text, trg_text = [], []
         for review, summary in zip(batch['reviewText'], batch['summary']):
             src_text.append(review)
             trg_text.append(summary)
-        idx = list(range(len(batch['summary'])))
-        idx.sort(key=lambda k: len(src_text[k].split()), reverse=True)
+        # texts were encoded once by encode_examples()
+        src_ids, trg_ids = batch['reviewText_ids'], batch['summary_ids']
+        lens = np.fromiter((len(ids) for ids in src_ids), dtype=np.int64, count=len(src_ids))
+        idx = np.argsort(-lens, kind='stable')  # longest first, ties keep batch order
         src_text = [src_text[i] for i in idx]
         trg_text = [trg_text[i] for i in idx]
+        src_ids, src_words = [src_ids[i] for i in idx], [batch['reviewText_oov'][i] for i in idx]
+        trg_ids, trg_words = [trg_ids[i] for i in idx], [batch['summary_oov'][i] for i in idx]
 
-        # generate changeable part for current batch
-        for review in src_text:
-            review = review.split()
-            for w in review:
-                if w not in self.word2id:
-                    self.word2id[w] = self.word_num
-                    self.id2word[self.word_num] = w
-                    self.word_num += 1
+        # generate changeable part for current batch, kept out of self so batches can be built in worker processes
+        oov = {}
+        for words in src_words:
+            for w in words:
+                if w not in oov:
+                    oov[w] = self.fixed_num + len(oov)
 
-        src_max_len = min(self.args.review_max_len, len(src_text[0].split()))
+        src_max_len = min(self.args.review_max_len, len(src_ids[0]))
         trg_max_len = self.args.sum_max_len
-        src, trg = [], []
-        src_embed, trg_embed = [], []
-        for review in src_text:
-            review = review.split()[:src_max_len]
-            cur_idx = [self.word_id(w) for w in review]
-            cur_idx.extend([self.PAD_IDX] * (src_max_len - len(review)))
-            src.append(cur_idx)
-            src_embed.append([i if i < self.fixed_num else self.UNK_IDX for i in cur_idx])
-        for summary in trg_text:
-            summary = summary.split() + [self.EOS_TOKEN]
-            summary = summary[:trg_max_len]
-            cur_idx = [self.word_id(w) for w in summary]
-            cur_idx.extend([self.PAD_IDX] * (trg_max_len - len(summary)))
-            trg.append(cur_idx)
-            trg_embed.append([i if i < self.fixed_num else self.UNK_IDX for i in cur_idx])
+        src = self.pad_ids(src_ids, src_max_len, src_words, oov)
+        trg = self.pad_ids(trg_ids, trg_max_len, trg_words, oov, eos=True)
+        src_embed, trg_embed = self.fixed_ids(src), self.fixed_ids(trg)
 
         src_user, src_product = [], []
         for i in idx:
@@ -205,57 +242,86 @@ class Vocab:
         u_review, u_sum, p_review, p_sum = [], [], [], []
         review_max_len = self.args.review_max_len
         sum_max_len = self.args.sum_max_len
+        eos_ids = np.array([self.EOS_IDX], dtype=np.int32)
         for i in idx:
             cur_user, cur_product = batch['userID'][i], batch['productID'][i]
-            mem_user, mem_product = batch['user_review'][i], batch['product_review'][i]
-            mem_user.sort(key=lambda p: p[-2], reverse=True)
-            mem_product.sort(key=lambda p: p[-2], reverse=True)
-            mem_user, mem_product = mem_user[:self.args.mem_size], mem_product[:self.args.mem_size]
+            # top mem_size memory pieces by score, ties keep their order as a stable sort would
+            mem_user = heapq.nlargest(self.args.mem_size, batch['user_review'][i], key=lambda p: p[-2])
+            mem_product = heapq.nlargest(self.args.mem_size, batch['product_review'][i], key=lambda p: p[-2])
             for mem_piece in mem_user:
                 mem_data = train_data[mem_piece[0]]
                 assert mem_data['userID'] == cur_user
-                review = mem_data['reviewText'].split()[:review_max_len]
-                cur_idx = [self.word_id(w) for w in review]
-                cur_idx.extend([self.PAD_IDX] * (review_max_len - len(review)))
-                cur_idx = [i if i < self.fixed_num else self.UNK_IDX for i in cur_idx]
-                u_review.append(cur_idx)
-                summary = mem_data['summary'].split()[:sum_max_len]
-                cur_idx = [self.word_id(w) for w in summary]
-                cur_idx.extend([self.PAD_IDX] * (sum_max_len - len(summary)))
-                cur_idx = [i if i < self.fixed_num else self.UNK_IDX for i in cur_idx]
-                u_sum.append(cur_idx)
+                u_review.append(mem_data['reviewText_ids'])
+                u_sum.append(mem_data['summary_ids'])
             for _ in range(len(mem_user), self.args.mem_size):  # 不足补全
-                u_review.append([self.EOS_IDX] + [self.PAD_IDX] * (review_max_len - 1))
-                u_sum.append([self.EOS_IDX] + [self.PAD_IDX] * (sum_max_len - 1))
+                u_review.append(eos_ids)
+                u_sum.append(eos_ids)
             for mem_piece in mem_product:
                 mem_data = train_data[mem_piece[0]]
                 assert mem_data['productID'] == cur_product
-                review = mem_data['reviewText'].split()[:review_max_len]
-                cur_idx = [self.word_id(w) for w in review]
-                cur_idx.extend([self.PAD_IDX] * (review_max_len - len(review)))
-                cur_idx = [i if i < self.fixed_num else self.UNK_IDX for i in cur_idx]
-                p_review.append(cur_idx)
-                summary = mem_data['summary'].split()[:sum_max_len]
-                cur_idx = [self.word_id(w) for w in summary]
-                cur_idx.extend([self.PAD_IDX] * (sum_max_len - len(summary)))
-                cur_idx = [i if i < self.fixed_num else self.UNK_IDX for i in cur_idx]
-                p_sum.append(cur_idx)
+                p_review.append(mem_data['reviewText_ids'])
+                p_sum.append(mem_data['summary_ids'])
             for _ in range(len(mem_product), self.args.mem_size):  # 不足补全
-                p_review.append([self.EOS_IDX] + [self.PAD_IDX] * (review_max_len - 1))
-                p_sum.append([self.EOS_IDX] + [self.PAD_IDX] * (sum_max_len - 1))
+                p_review.append(eos_ids)
+                p_sum.append(eos_ids)
+        u_review, u_sum = self.pad_ids(u_review, review_max_len), self.pad_ids(u_sum, sum_max_len)
+        p_review, p_sum = self.pad_ids(p_review, review_max_len), self.pad_ids(p_sum, sum_max_len)
 
-        src, trg = torch.LongTensor(src), torch.LongTensor(trg)
-        src_embed, trg_embed = torch.LongTensor(src_embed), torch.LongTensor(trg_embed)
+        src, trg = torch.from_numpy(src), torch.from_numpy(trg)
+        src_embed, trg_embed = torch.from_numpy(src_embed), torch.from_numpy(trg_embed)
         src_user, src_product = torch.LongTensor(src_user), torch.LongTensor(src_product)
-        u_review, u_sum, p_review, p_sum = torch.LongTensor(u_review), torch.LongTensor(u_sum), torch.LongTensor(
-            p_review), torch.LongTensor(p_sum)
-        if self.args.use_cuda:
-            src, trg = src.cuda(), trg.cuda()
-            src_embed, trg_embed = src_embed.cuda(), trg_embed.cuda()
-            src_user, src_product = src_user.cuda(), src_product.cuda()
-            u_review, u_sum, p_review, p_sum = u_review.cuda(), u_sum.cuda(), p_review.cuda(), p_sum.cuda()
+        u_review, u_sum, p_review, p_sum = torch.from_numpy(u_review), torch.from_numpy(u_sum), torch.from_numpy(
+            p_review), torch.from_numpy(p_sum)
+
+        return Batch(src=src, trg=trg, src_embed=src_embed, trg_embed=trg_embed, src_user=src_user,
+                     src_product=src_product, u_review=u_review, u_sum=u_sum, p_review=p_review, p_sum=p_sum,
+                     src_text=src_text, trg_text=trg_text, vocab_size=self.fixed_num + len(oov),
+                     oov_words=list(oov))
+
+
+# Batch: tensors and texts of a batch, built on cpu, fields are read with batch[key]
+# not a Mapping, so DataLoader(pin_memory=True) calls its pin_memory() instead of rebuilding it as a plain dict
+# cuda() then copies it to gpu asynchronously
+class Batch(object):
+    def __init__(self, **fields):
+        self.fields = fields
+        self.buffers = None
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    # pack the tensors of each dtype into one pinned buffer, the fields then hold views of it
+    def pin_memory(self):
+        groups = {}
+        for k, v in self.fields.items():
+            if torch.is_tensor(v):
+                groups.setdefault(v.dtype, []).append(k)
+        self.buffers = []
+        for dtype, keys in groups.items():
+            buf = torch.empty(sum(self.fields[k].numel() for k in keys), dtype=dtype, pin_memory=True)
+            torch.cat([self.fields[k].reshape(-1) for k in keys], out=buf)
+            self.buffers.append((buf, keys))
+            self.unpack(buf, keys)
+        return self
+
+    def unpack(self, buf, keys):
+        offset = 0
+        for k in keys:
+            n = self.fields[k].numel()
+            self.fields[k] = buf[offset:offset + n].view(self.fields[k].shape)
+            offset += n
 
-        return src, trg, src_embed, trg_embed, src_user, src_product, u_review, u_sum, p_review, p_sum, src_text, trg_text
+    # one host to gpu copy per dtype once pin_memory() has packed the batch in the DataLoader's pinning thread,
+    # otherwise the tensors are copied one by one rather than packed and pinned on the training thread
+    def cuda(self):
+        if self.buffers is None:
+            for k, v in self.fields.items():
+                if torch.is_tensor(v):
+                    self.fields[k] = v.cuda(non_blocking=True)
+            return self
+        for buf, keys in self.buffers:
+            self.unpack(buf.cuda(non_blocking=True), keys)
+        return self
 
 
 class Dataset(data.Dataset):
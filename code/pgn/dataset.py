@@ -1,3 +1,4 @@
+import torch
 import torch.utils.data as data
 
 
@@ -13,3 +14,48 @@ class Dataset(data.Dataset):
 
     def __len__(self):
         return len(self.examples)
+
+
+# Batch: tensors and texts of a batch, built on cpu, fields are read with batch[key]
+# not a Mapping, so DataLoader(pin_memory=True) calls its pin_memory() instead of rebuilding it as a plain dict
+# cuda() then copies it to gpu asynchronously
+class Batch(object):
+    def __init__(self, **fields):
+        self.fields = fields
+        self.buffers = None
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    # pack the tensors of each dtype into one pinned buffer, the fields then hold views of it
+    def pin_memory(self):
+        groups = {}
+        for k, v in self.fields.items():
+            if torch.is_tensor(v):
+                groups.setdefault(v.dtype, []).append(k)
+        self.buffers = []
+        for dtype, keys in groups.items():
+            buf = torch.empty(sum(self.fields[k].numel() for k in keys), dtype=dtype, pin_memory=True)
+            torch.cat([self.fields[k].reshape(-1) for k in keys], out=buf)
+            self.buffers.append((buf, keys))
+            self.unpack(buf, keys)
+        return self
+
+    def unpack(self, buf, keys):
+        offset = 0
+        for k in keys:
+            n = self.fields[k].numel()
+            self.fields[k] = buf[offset:offset + n].view(self.fields[k].shape)
+            offset += n
+
+    # one host to gpu copy per dtype once pin_memory() has packed the batch in the DataLoader's pinning thread,
+    # otherwise the tensors are copied one by one rather than packed and pinned on the training thread
+    def cuda(self):
+        if self.buffers is None:
+            for k, v in self.fields.items():
+                if torch.is_tensor(v):
+                    self.fields[k] = v.cuda(non_blocking=True)
+            return self
+        for buf, keys in self.buffers:
+            self.unpack(buf.cuda(non_blocking=True), keys)
+        return self
@@ -6,6 +6,7 @@ import os
 import json
 import argparse
 import random
+from functools import partial
 import numpy as np
 from tqdm import tqdm
 import torch
@@ -41,6 +42,8 @@ parser.add_argument('-lr_decay', type=float, default=0.5)
 parser.add_argument('-lr_decay_start', type=int, default=6)
 parser.add_argument('-max_norm', type=float, default=5.0)
 parser.add_argument('-batch_size', type=int, default=32)
+parser.add_argument('-num_workers', type=int, default=4)
+parser.add_argument('-amp', action='store_true')
 parser.add_argument('-epochs', type=int, default=10)
 parser.add_argument('-seed', type=int, default=2333)
 parser.add_argument('-print_every', type=int, default=10)
@@ -63,6 +66,11 @@ if not os.path.exists(args.output_dir):
     os.mkdir(args.output_dir)
 
 
+def my_collate(batch, vocab):
+    batch = {key: [d[key] for d in batch] for key in batch[0]}
+    return vocab.read_batch(batch)
+
+
 def adjust_learning_rate(optimizer, index):
     lr = args.lr * (args.lr_decay ** index)
     for param_group in optimizer.param_groups:
@@ -78,10 +86,15 @@ def evaluate(net, criterion, vocab, data_iter, train_next=True):
     rouge = RougeCalculator(stopwords=False, lang="en")
     with torch.no_grad():
         for batch in tqdm(data_iter):
-            src, trg, src_embed, trg_embed, src_mask, src_lens, trg_lens, src_text, trg_text = vocab.read_batch(batch)
-            pre_output1 = net(src, trg, src_embed, trg_embed, vocab.word_num, src_mask, src_lens, trg_lens)
-            pre_output = net(src, trg, src_embed, trg_embed, vocab.word_num, src_mask, src_lens, trg_lens, test=True)
-            output = torch.log(pre_output1.view(-1, pre_output1.size(-1)) + 1e-20)
+            if args.use_cuda:
+                batch = batch.cuda()
+            src, trg, src_embed, trg_embed = batch['src'], batch['trg'], batch['src_embed'], batch['trg_embed']
+            src_mask, src_lens, trg_lens = batch['src_mask'], batch['src_lens'], batch['trg_lens']
+            src_text, trg_text = batch['src_text'], batch['trg_text']
+            pre_output1 = net(src, trg, src_embed, trg_embed, batch['vocab_size'], src_mask, src_lens, trg_lens)
+            pre_output = net(src, trg, src_embed, trg_embed, batch['vocab_size'], src_mask, src_lens, trg_lens,
+                             test=True)
+            output = pre_output1.view(-1, pre_output1.size(-1))
             trg_output = trg.view(-1)
             loss += criterion(output, trg_output).data.item() / len(src_lens)
             reviews.extend(src_text)
@@ -93,7 +106,7 @@ def evaluate(net, criterion, vocab, data_iter, train_next=True):
                 for idx in summary:
                     if idx == vocab.EOS_IDX:
                         break
-                    w = vocab.id_word(idx)
+                    w = vocab.id_word(idx, batch['oov_words'])
                     cur_sum.append(w)
                 cur_sum = ' '.join(cur_sum).strip()
                 if len(cur_sum) == 0:
@@ -162,33 +175,48 @@ def train():
 
     print('Deleting rare words...')
     embed = vocab.trim()
+    vocab.encode_examples(train_data + val_data)
 
     args.embed_num = len(embed)
     args.embed_dim = len(embed[0])
 
     train_dataset = Dataset(train_data)
     val_dataset = Dataset(val_data)
-    train_iter = DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True)
-    val_iter = DataLoader(dataset=val_dataset, batch_size=args.batch_size, shuffle=False)
+    collate = partial(my_collate, vocab=vocab)
+    train_iter = DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=collate,
+                            num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                            pin_memory=args.use_cuda)
+    val_iter = DataLoader(dataset=val_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=collate,
+                          num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                          pin_memory=args.use_cuda)
 
     net = EncoderDecoder(args, embed)
     if args.use_cuda:
         net.cuda()
     criterion = nn.NLLLoss(ignore_index=vocab.PAD_IDX, reduction='sum')
     optim = torch.optim.Adam(net.parameters(), lr=args.lr)
+    # -amp: forward in mixed precision (fp16 matmuls and rnns, fp32 weights), loss scaled against fp16 underflow
+    use_amp = args.use_cuda and args.amp
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
     print('Begin training...')
     for epoch in range(1, args.epochs + 1):
         if epoch >= args.lr_decay_start:
             adjust_learning_rate(optim, epoch - args.lr_decay_start + 1)
         for i, batch in enumerate(train_iter):
-            src, trg, src_embed, trg_embed, src_mask, src_lens, trg_lens, _1, _2 = vocab.read_batch(batch)
-            pre_output = net(src, trg, src_embed, trg_embed, vocab.word_num, src_mask, src_lens, trg_lens)
-            pre_output = torch.log(pre_output.view(-1, pre_output.size(-1)) + 1e-20)
+            if args.use_cuda:
+                batch = batch.cuda()
+            src, trg, src_embed, trg_embed = batch['src'], batch['trg'], batch['src_embed'], batch['trg_embed']
+            src_mask, src_lens, trg_lens = batch['src_mask'], batch['src_lens'], batch['trg_lens']
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                pre_output = net(src, trg, src_embed, trg_embed, batch['vocab_size'], src_mask, src_lens, trg_lens)
+            pre_output = pre_output.view(-1, pre_output.size(-1))
             trg_output = trg.view(-1)
             loss = criterion(pre_output, trg_output) / len(src_lens)
-            loss.backward()
+            scaler.scale(loss).backward()
+            scaler.unscale_(optim)
             clip_grad_norm_(net.parameters(), args.max_norm)
-            optim.step()
+            scaler.step(optim)
+            scaler.update()
             optim.zero_grad()
 
             cnt = (epoch - 1) * len(train_iter) + i
@@ -246,10 +274,14 @@ def test():
         vocab.add_sentence(test_data[-1]['reviewText'].split())
         vocab.add_sentence(test_data[-1]['summary'].split())
     embed = vocab.trim()
+    vocab.encode_examples(test_data)
     args.embed_num = len(embed)
     args.embed_dim = len(embed[0])
     test_dataset = Dataset(test_data)
-    test_iter = DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False)
+    collate = partial(my_collate, vocab=vocab)
+    test_iter = DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=collate,
+                           num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                           pin_memory=args.use_cuda)
 
     print('Loading model...')
     checkpoint = torch.load(args.save_path + args.load_model)
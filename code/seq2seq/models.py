@@ -16,12 +16,14 @@ class EncoderDecoder(nn.Module):
         self.embed = nn.Embedding(args.embed_num, args.embed_dim)
         if embed is not None:
             self.embed.weight.data.copy_(embed)
+        # <SOS> index, first decoder input
+        self.register_buffer('sos_idx', torch.LongTensor([1]), persistent=False)
         # Encoder
         self.encoder_rnn = nn.GRU(args.embed_dim, args.hidden_size, args.num_layers,
                                   batch_first=True, bidirectional=True, dropout=args.encoder_dropout)
         # Decoder
-        self.decoder_rnn = nn.GRU(args.embed_dim, args.hidden_size, args.num_layers,
-                                  batch_first=True, dropout=args.decoder_dropout)
+        self.decoder_rnn = StepGRU(args.embed_dim, args.hidden_size, args.num_layers,
+                                   batch_first=True, dropout=args.decoder_dropout)
         self.init_hidden = nn.Linear(2 * args.hidden_size, args.hidden_size)
         self.dropout_layer = nn.Dropout(p=args.decoder_dropout)
         self.pre_output_layer = nn.Linear(args.hidden_size + args.embed_dim, args.hidden_size)
@@ -61,7 +63,7 @@ class EncoderDecoder(nn.Module):
         teacher = True if np.random.random() < self.args.teacher else False
         for i in range(max_len):
             if i == 0:  # <SOS> embedding
-                prev_embed = self.embed(torch.LongTensor([1]).cuda()).repeat(len(src), 1).unsqueeze(1)
+                prev_embed = self.embed(self.sos_idx).expand(len(src), 1, -1)
             else:
                 if not test and teacher:  # last trg word embedding
                     prev_embed = trg_embed[:, i - 1].unsqueeze(1)
@@ -78,3 +80,18 @@ class EncoderDecoder(nn.Module):
     def save(self, dir):
         checkpoint = {'model': self.state_dict(), 'args': self.args}
         torch.save(checkpoint, dir)
+
+
+# nn.GRU for a single decoder step: each layer runs as a GRU cell, skipping the cudnn sequence setup
+# parameters (and state_dict keys) are the same as nn.GRU, input: [B, 1, I], hx: [num_layers, B, H]
+class StepGRU(nn.GRU):
+
+    def forward(self, input, hx):
+        x, hidden = input.squeeze(1), []
+        for l in range(self.num_layers):
+            if l > 0:
+                x = F.dropout(x, p=self.dropout, training=self.training)
+            x = torch.gru_cell(x, hx[l], getattr(self, 'weight_ih_l%d' % l), getattr(self, 'weight_hh_l%d' % l),
+                               getattr(self, 'bias_ih_l%d' % l), getattr(self, 'bias_hh_l%d' % l))
+            hidden.append(x)
+        return x.unsqueeze(1), torch.stack(hidden)
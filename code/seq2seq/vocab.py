@@ -7,7 +7,6 @@ class Vocab:
     def __init__(self, args, embed=None):
         self.args = args
         self.pretrained_embed = embed
-        self.embed = []
         self.PAD_IDX = 0
         self.SOS_IDX = 1
         self.EOS_IDX = 2
@@ -22,16 +21,20 @@ class Vocab:
         self.id2word = {v: k for k, v in self.word2id.items()}
         self.word2cnt = {self.PAD_TOKEN: 10000, self.SOS_TOKEN: 10000, self.EOS_TOKEN: 10000,
                          self.UNK_TOKEN: 10000}
-        for i in range(4):
-            self.embed.append(np.random.normal(size=args.embed_dim))
+        # embed: [pretrained_num, embed_dim] float32 array, row i is the vector of word i
+        # special tokens get random rows here, words added later get random rows in trim()
+        pretrained = []
         if embed is not None:
             for w in sorted(embed.keys()):
                 if w not in self.word2id:
                     self.word2id[w] = self.next_idx
                     self.id2word[self.next_idx] = w
                     self.word2cnt[w] = 0
-                    self.embed.append(embed[w])
+                    pretrained.append(embed[w])
                     self.next_idx += 1
+        self.embed = np.concatenate([np.random.normal(size=(4, args.embed_dim)).astype(np.float32),
+                                     np.asarray(pretrained, dtype=np.float32).reshape(-1, args.embed_dim)])
+        self.pretrained_num = self.next_idx
 
     def add_sentence(self, sent):
         for w in sent:
@@ -39,7 +42,6 @@ class Vocab:
                 self.word2id[w] = self.next_idx
                 self.id2word[self.next_idx] = w
                 self.word2cnt[w] = 1
-                self.embed.append(np.random.normal(size=self.args.embed_dim))
                 self.next_idx += 1
             else:
                 self.word2cnt[w] += 1
@@ -54,18 +56,23 @@ class Vocab:
                 reserved_idx.append(i)
         cnt = 0
         word2id, id2word, word2cnt = {}, {}, {}
-        embed = []
         for w in reserved_words:
             word2id[w] = cnt
             id2word[cnt] = w
             word2cnt[w] = self.word2cnt[w]
             cnt += 1
-        for i in reserved_idx:
-            embed.append(self.embed[i])
+        # reserved ids are sorted, those below pretrained_num take their rows from self.embed,
+        # the rest get random vectors drawn in one call
+        reserved_idx = np.asarray(reserved_idx, dtype=np.int64)
+        kept_num = np.searchsorted(reserved_idx, self.pretrained_num)
+        embed = np.empty((cnt, self.args.embed_dim), dtype=np.float32)
+        embed[:kept_num] = self.embed[reserved_idx[:kept_num]]
+        embed[kept_num:] = np.random.normal(size=(cnt - kept_num, self.args.embed_dim))
         assert len(word2id) == len(id2word) and len(id2word) == len(word2cnt) and len(word2cnt) == len(embed)
         self.word2id, self.id2word, self.word2cnt, self.embed = word2id, id2word, word2cnt, embed
+        self.pretrained_num = cnt
         print('Vocab size: %d' % len(self.word2id))
-        embed = torch.FloatTensor(embed)
+        embed = torch.from_numpy(embed)
         if self.args.use_cuda:
             embed = embed.cuda()
         return embed
@@ -85,25 +92,29 @@ class Vocab:
         for review, summary in zip(batch['reviewText'], batch['summary']):
             src_text.append(review)
             trg_text.append(summary)
-        idx = list(range(len(batch['summary'])))
-        idx.sort(key=lambda k: len(src_text[k].split()), reverse=True)
+        # split every text once, the token lists are reused below
+        src_tokens = [review.split() for review in src_text]
+        trg_tokens = [summary.split() for summary in trg_text]
+        lens = np.fromiter((len(review) for review in src_tokens), dtype=np.int64, count=len(src_tokens))
+        idx = np.argsort(-lens, kind='stable')  # longest first, ties keep batch order
         src_text = [src_text[i] for i in idx]
         trg_text = [trg_text[i] for i in idx]
+        src_tokens = [src_tokens[i] for i in idx]
+        trg_tokens = [trg_tokens[i] for i in idx]
 
-        src_max_len = len(src_text[0].split())
+        src_max_len = len(src_tokens[0])
         trg_max_len = self.args.sum_max_len
-        src, trg, src_mask, src_lens, trg_lens = [], [], [], [], []
-        for review in src_text:
-            review = review.split()[:src_max_len]
+        src, trg, src_lens, trg_lens = [], [], [], []
+        for review in src_tokens:
+            review = review[:src_max_len]
             cur_idx = []
             for w in review:
                 cur_idx.append(self.word_id(w))
             cur_idx.extend([self.PAD_IDX] * (src_max_len - len(review)))
             src.append(cur_idx)
-            src_mask.append([1] * len(review) + [0] * (src_max_len - len(review)))
             src_lens.append(len(review))
-        for summary in trg_text:
-            summary = summary.split() + [self.EOS_TOKEN]
+        for summary in trg_tokens:
+            summary = summary + [self.EOS_TOKEN]
             summary = summary[:trg_max_len]
             cur_idx = []
             for w in summary:
@@ -111,7 +122,8 @@ class Vocab:
             cur_idx.extend([self.PAD_IDX] * (trg_max_len - len(summary)))
             trg.append(cur_idx)
             trg_lens.append(len(summary))
-        src, trg, src_mask = torch.LongTensor(src), torch.LongTensor(trg), torch.LongTensor(src_mask)
+        src, trg = torch.LongTensor(src), torch.LongTensor(trg)
+        src_mask = (torch.arange(src_max_len).unsqueeze(0) < torch.LongTensor(src_lens).unsqueeze(1)).long()
         if self.args.use_cuda:
             src, trg, src_mask = src.cuda(), trg.cuda(), src_mask.cuda()
 